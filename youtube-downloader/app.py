@@ -1,526 +1,1043 @@
-from flask import Flask, render_template, request, send_file, jsonify
-import yt_dlp
-import os
-import threading
-import time
-import re
-import logging
-from urllib.parse import urlparse, parse_qs
-from datetime import datetime, timedelta
-
-# Set up logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-app = Flask(__name__)
-app.config['DOWNLOAD_FOLDER'] = 'downloads'
-app.config['MAX_DOWNLOAD_AGE'] = timedelta(hours=1)  # Clean up files older than 1 hour
-
-# Ensure download directory exists
-if not os.path.exists(app.config['DOWNLOAD_FOLDER']):
-    os.makedirs(app.config['DOWNLOAD_FOLDER'])
-
-# Store download progress and metadata
-download_progress = {}
-download_metadata = {}
-
-def sanitize_filename(filename):
-    """Remove invalid characters from filename"""
-    # Remove invalid file characters
-    filename = re.sub(r'[<>:"/\\|?*]', '', filename)
-    # Replace spaces with underscores
-    filename = filename.replace(' ', '_')
-    # Limit length to avoid OS path limits
-    if len(filename) > 150:
-        filename = filename[:150]
-    return filename
-
-def cleanup_old_files():
-    """Remove files older than MAX_DOWNLOAD_AGE"""
-    try:
-        now = datetime.now()
-        for filename in os.listdir(app.config['DOWNLOAD_FOLDER']):
-            filepath = os.path.join(app.config['DOWNLOAD_FOLDER'], filename)
-            if os.path.isfile(filepath):
-                file_time = datetime.fromtimestamp(os.path.getctime(filepath))
-                if now - file_time > app.config['MAX_DOWNLOAD_AGE']:
-                    os.remove(filepath)
-                    logger.info(f"Removed old file: {filename}")
-    except Exception as e:
-        logger.error(f"Error in cleanup_old_files: {e}")
-
-def format_duration(duration):
-    """Format duration from seconds to HH:MM:SS or MM:SS"""
-    if not duration:
-        return "Unknown"
-    
-    hours = int(duration // 3600)
-    minutes = int((duration % 3600) // 60)
-    seconds = int(duration % 60)
-    
-    if hours > 0:
-        return f"{hours}:{minutes:02d}:{seconds:02d}"
-    else:
-        return f"{minutes}:{seconds:02d}"
-
-def format_views(views):
-    """Format view count in a readable format"""
-    if not views:
-        return "Unknown"
-    
-    if views >= 1000000:
-        return f"{views / 1000000:.1f}M"
-    elif views >= 1000:
-        return f"{views / 1000:.1f}K"
-    else:
-        return str(views)
-
-def search_youtube_videos(query, max_results=20):
-    """Search for YouTube videos using yt-dlp"""
-    try:
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'skip_download': True,
-            'extract_flat': False,  # Get detailed info
-        }
-        
-        search_query = f"ytsearch{max_results}:{query}"
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            search_results = ydl.extract_info(search_query, download=False)
-            
-            videos = []
-            if 'entries' in search_results:
-                for entry in search_results['entries']:
-                    if entry:  # Sometimes entries can be None
-                        video_info = {
-                            'id': entry.get('id', ''),
-                            'title': entry.get('title', 'Unknown Title'),
-                            'thumbnail': entry.get('thumbnail', ''),
-                            'duration': entry.get('duration', 0),
-                            'duration_formatted': format_duration(entry.get('duration', 0)),
-                            'views': entry.get('view_count', 0),
-                            'views_formatted': format_views(entry.get('view_count', 0)),
-                            'author': entry.get('uploader', 'Unknown Author'),
-                            'url': f"https://www.youtube.com/watch?v={entry.get('id', '')}",
-                            'description': entry.get('description', '')[:200] + '...' if entry.get('description') else '',
-                            'upload_date': entry.get('upload_date', '')
-                        }
-                        videos.append(video_info)
-            
-            return videos
-    except Exception as e:
-        logger.error(f"Error in search_youtube_videos: {e}")
-        return []
-
-def get_video_info(url):
-    try:
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'skip_download': True,
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            video_info = {
-                'title': info.get('title', 'Unknown Title'),
-                'thumbnail': info.get('thumbnail', ''),
-                'duration': info.get('duration', 0),
-                'duration_formatted': format_duration(info.get('duration', 0)),
-                'views': info.get('view_count', 0),
-                'views_formatted': format_views(info.get('view_count', 0)),
-                'author': info.get('uploader', 'Unknown Author'),
-                'video_id': info.get('id', ''),
-                'description': info.get('description', '')[:300] + '...' if info.get('description') else '',
-                'upload_date': info.get('upload_date', '')
-            }
-            return video_info
-    except Exception as e:
-        logger.error(f"Error in get_video_info: {e}")
-        return {'error': str(e)}
-
-def get_video_id(url):
-    """Extract video ID from YouTube URL"""
-    try:
-        # List of domains that YouTube uses
-        youtube_domains = ['youtube.com', 'www.youtube.com', 'm.youtube.com', 'youtu.be']
-        
-        parsed_url = urlparse(url)
-        domain = parsed_url.netloc.lower()
-        
-        # Check if the domain is a YouTube domain
-        if any(youtube_domain in domain for youtube_domain in youtube_domains):
-            if 'youtu.be' in domain:
-                # For shortened youtu.be URLs
-                return parsed_url.path[1:] if parsed_url.path else None
-            else:
-                # For standard YouTube URLs
-                query_params = parse_qs(parsed_url.query)
-                return query_params.get('v', [None])[0]
-        return None
-    except Exception as e:
-        logger.error(f"Error in get_video_id: {e}")
-        return None
-
-def progress_hook(d, video_id):
-    """Progress hook for yt-dlp downloads"""
-    if video_id not in download_progress:
-        return
-        
-    if d['status'] == 'downloading':
-        total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate') or 1
-        downloaded_bytes = d.get('downloaded_bytes', 0)
-        progress_percent = (downloaded_bytes / total_bytes) * 100
-        
-        download_progress[video_id]['progress'] = progress_percent
-        download_progress[video_id]['status'] = 'downloading'
-        download_progress[video_id]['downloaded_bytes'] = downloaded_bytes
-        download_progress[video_id]['total_bytes'] = total_bytes
-        
-    elif d['status'] == 'finished':
-        download_progress[video_id]['progress'] = 100
-        download_progress[video_id]['status'] = 'processing'  # Set to processing, will be updated to completed later
-        download_progress[video_id]['filepath'] = d['filename']
-        logger.info(f"Download finished. File path: {d['filename']}")
-
-def download_video(url, quality, audio_only=False):
-    """Download video with improved error handling and file tracking"""
-    video_id = get_video_id(url)
-    if not video_id:
-        logger.error("Could not extract video ID from URL")
-        return None, "Could not extract video ID from URL"
-    
-    try:
-        # Clean up old files before starting new download
-        cleanup_old_files()
-        
-        # Set up options for yt-dlp with better filename handling
-        ydl_opts = {
-            'outtmpl': os.path.join(app.config['DOWNLOAD_FOLDER'], '%(title)s_%(id)s.%(ext)s'),
-            'progress_hooks': [lambda d: progress_hook(d, video_id)],
-            'quiet': False,
-            'no_warnings': False,
-            'restrictfilenames': True,  # This helps with filename issues
-        }
-        
-        if audio_only:
-            # Download audio only
-            ydl_opts['format'] = 'bestaudio/best'
-            ydl_opts['postprocessors'] = [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }]
-        else:
-            # Download video with specified quality
-            quality_map = {
-                '144p': 'bestvideo[height<=144]+bestaudio/best[height<=144]',
-                '240p': 'bestvideo[height<=240]+bestaudio/best[height<=240]',
-                '360p': 'bestvideo[height<=360]+bestaudio/best[height<=360]',
-                '480p': 'bestvideo[height<=480]+bestaudio/best[height<=480]',
-                '720p': 'bestvideo[height<=720]+bestaudio/best[height<=720]',
-                '1080p': 'bestvideo[height<=1080]+bestaudio/best[height<=1080]',
-                'highest': 'bestvideo+bestaudio/best'
-            }
-            ydl_opts['format'] = quality_map.get(quality, 'bestvideo+bestaudio/best')
-        
-        # Initialize download progress
-        download_progress[video_id] = {
-            'progress': 0, 
-            'filename': None, 
-            'filepath': None,
-            'status': 'starting',
-            'start_time': time.time()
-        }
-        
-        # Start download
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            
-            # Store metadata immediately after getting info
-            download_metadata[video_id] = {
-                'title': info.get('title', 'Unknown'),
-                'download_time': datetime.now().isoformat(),
-                'url': url,
-                'quality': quality,
-                'audio_only': audio_only
-            }
-            
-            # Wait a bit for file processing to complete
-            time.sleep(2)
-            
-            # Try to find the downloaded file
-            actual_file = None
-            expected_filename = ydl.prepare_filename(info)
-            
-            # If audio_only and we have post-processors, the extension might have changed
-            if audio_only:
-                base_name = os.path.splitext(expected_filename)[0]
-                expected_filename = base_name + '.mp3'
-            
-            logger.info(f"Expected filename: {expected_filename}")
-            
-            # Check if the exact file exists
-            if os.path.exists(expected_filename) and os.path.getsize(expected_filename) > 0:
-                actual_file = expected_filename
-            else:
-                # Search for similar files in the download directory
-                try:
-                    download_dir = app.config['DOWNLOAD_FOLDER']
-                    for f in os.listdir(download_dir):
-                        file_path = os.path.join(download_dir, f)
-                        if os.path.isfile(file_path) and os.path.getsize(file_path) > 0:
-                            # Check if the video ID is in the filename
-                            if video_id in f:
-                                actual_file = file_path
-                                logger.info(f"Found file by video ID: {f}")
-                                break
-                    
-                    # If still not found, get the most recent file
-                    if not actual_file:
-                        files_with_time = []
-                        for f in os.listdir(download_dir):
-                            file_path = os.path.join(download_dir, f)
-                            if os.path.isfile(file_path) and os.path.getsize(file_path) > 0:
-                                mtime = os.path.getmtime(file_path)
-                                files_with_time.append((file_path, f, mtime))
-                        
-                        if files_with_time:
-                            # Sort by modification time (most recent first)
-                            files_with_time.sort(key=lambda x: x[2], reverse=True)
-                            actual_file = files_with_time[0][0]
-                            logger.info(f"Using most recent file: {files_with_time[0][1]}")
-                            
-                except Exception as e:
-                    logger.error(f"Error searching for downloaded file: {e}")
-            
-            if actual_file:
-                final_filename = os.path.basename(actual_file)
-                
-                # Update progress and metadata with final file info
-                download_progress[video_id]['filename'] = final_filename
-                download_progress[video_id]['filepath'] = actual_file
-                download_progress[video_id]['status'] = 'completed'
-                download_progress[video_id]['end_time'] = time.time()
-                
-                download_metadata[video_id]['filename'] = final_filename
-                
-                logger.info(f"Download completed successfully: {actual_file}")
-                return actual_file, None
-            else:
-                error_msg = "Download completed but file not found"
-                download_progress[video_id]['status'] = 'error'
-                download_progress[video_id]['error'] = error_msg
-                logger.error(f"File not found after download. Expected: {expected_filename}")
-                return None, error_msg
-                
-    except Exception as e:
-        error_msg = str(e)
-        logger.error(f"Error in download_video: {error_msg}")
-        if video_id in download_progress:
-            download_progress[video_id]['status'] = 'error'
-            download_progress[video_id]['error'] = error_msg
-        return None, error_msg
-
-@app.route('/')
-def index():
-    return render_template('index.html')
-
-@app.route('/api/search', methods=['GET'])
-def search_videos():
-    query = request.args.get('q', '').strip()
-    max_results = int(request.args.get('max_results', 20))
-    
-    if not query:
-        return jsonify({'error': 'No search query provided'})
-    
-    try:
-        videos = search_youtube_videos(query, max_results)
-        return jsonify({'videos': videos, 'total': len(videos)})
-    except Exception as e:
-        logger.error(f"Search error: {e}")
-        return jsonify({'error': str(e)})
-
-@app.route('/api/video_info', methods=['GET'])
-def video_info():
-    url = request.args.get('url')
-    if not url:
-        return jsonify({'error': 'No URL provided'})
-    
-    info = get_video_info(url)
-    return jsonify(info)
-
-@app.route('/api/download', methods=['POST'])
-def download():
-    data = request.json
-    url = data.get('url')
-    quality = data.get('quality')
-    audio_only = data.get('audio_only', False)
-    
-    if not url:
-        return jsonify({'error': 'No URL provided'})
-    
-    # Get video ID for progress tracking
-    video_id = get_video_id(url)
-    if not video_id:
-        return jsonify({'error': 'Could not extract video ID from URL'})
-    
-    # Clean up any previous state for this video
-    if video_id in download_progress:
-        del download_progress[video_id]
-    if video_id in download_metadata:
-        del download_metadata[video_id]
-    
-    # Start download in a separate thread
-    thread = threading.Thread(target=download_video, args=(url, quality, audio_only))
-    thread.daemon = True
-    thread.start()
-    
-    return jsonify({'video_id': video_id})
-
-@app.route('/api/progress/<video_id>', methods=['GET'])
-def progress(video_id):
-    if video_id in download_progress:
-        progress_data = download_progress[video_id].copy()
-        
-        # If download is completed, verify file still exists
-        if progress_data.get('status') == 'completed':
-            filename = progress_data.get('filename')
-            if filename:
-                file_path = os.path.join(app.config['DOWNLOAD_FOLDER'], filename)
-                if not os.path.exists(file_path):
-                    progress_data['status'] = 'error'
-                    progress_data['error'] = 'Downloaded file not found'
-        
-        return jsonify(progress_data)
-    return jsonify({'progress': 0, 'status': 'not found'})
-
-@app.route('/api/download_file/<video_id>', methods=['GET'])
-def download_file(video_id):
-    """Handle file download requests"""
-    logger.info(f"Download file requested for video_id: {video_id}")
-    logger.info(f"Available metadata keys: {list(download_metadata.keys())}")
-    
-    # Check if we have metadata for this video
-    if video_id not in download_metadata:
-        logger.warning(f"No metadata found for video_id: {video_id}")
-        
-        # Try to find any recent download files as fallback
-        try:
-            recent_files = []
-            current_time = time.time()
-            for filename in os.listdir(app.config['DOWNLOAD_FOLDER']):
-                filepath = os.path.join(app.config['DOWNLOAD_FOLDER'], filename)
-                if os.path.isfile(filepath):
-                    file_age = current_time - os.path.getctime(filepath)
-                    file_size = os.path.getsize(filepath)
-                    if file_age < 300 and file_size > 0:  # Files from last 5 minutes
-                        recent_files.append((filepath, filename, file_age))
-            
-            if recent_files:
-                # Sort by creation time, get the most recent
-                recent_files.sort(key=lambda x: x[2])  # Sort by age (ascending)
-                most_recent = recent_files[0]
-                logger.info(f"Using most recent file as fallback: {most_recent[1]}")
-                
-                # Create temporary metadata
-                download_metadata[video_id] = {
-                    'filename': most_recent[1],
-                    'title': 'Downloaded Video',
-                    'download_time': datetime.now().isoformat()
-                }
-                
-        except Exception as e:
-            logger.error(f"Error finding fallback file: {e}")
-            return jsonify({'error': 'Download not found or expired'}), 404
-        
-        if video_id not in download_metadata:
-            return jsonify({'error': 'Download not found or expired'}), 404
-    
-    filename = download_metadata[video_id]['filename']
-    filepath = os.path.join(app.config['DOWNLOAD_FOLDER'], filename)
-    
-    logger.info(f"Looking for file: {filepath}")
-    
-    # Security check to prevent directory traversal
-    if '..' in filename or filename.startswith('/'):
-        logger.warning(f"Invalid filename detected: {filename}")
-        return jsonify({'error': 'Invalid filename'}), 400
-    
-    # Check if file exists and is not empty
-    if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
-        # Get the title for download name
-        title = download_metadata[video_id].get('title', 'video')
-        safe_title = sanitize_filename(title)
-        file_extension = os.path.splitext(filename)[1]
-        download_name = f"{safe_title}{file_extension}"
-        
-        logger.info(f"Sending file: {filepath} as {download_name}")
-        
-        # Clean up the progress and metadata AFTER successful response
-        def cleanup_after_send():
-            try:
-                time.sleep(5)  # Wait 5 seconds before cleanup
-                if video_id in download_progress:
-                    del download_progress[video_id]
-                if video_id in download_metadata:
-                    del download_metadata[video_id]
-            except Exception as e:
-                logger.error(f"Error in cleanup: {e}")
-        
-        try:
-            response = send_file(filepath, as_attachment=True, download_name=download_name)
-            # Schedule cleanup after response is sent
-            cleanup_thread = threading.Thread(target=cleanup_after_send)
-            cleanup_thread.daemon = True
-            cleanup_thread.start()
-            return response
-        except Exception as send_error:
-            logger.error(f"Error sending file: {send_error}")
-            return jsonify({'error': 'Error sending file'}), 500
-    
-    # If file not found, try to find a similar file
-    logger.warning(f"File not found at expected path: {filepath}")
-    try:
-        for f in os.listdir(app.config['DOWNLOAD_FOLDER']):
-            file_path = os.path.join(app.config['DOWNLOAD_FOLDER'], f)
-            if os.path.isfile(file_path) and os.path.getsize(file_path) > 0:
-                # Match by video ID or filename similarity
-                if video_id in f or f.startswith(os.path.splitext(filename)[0][:20]):
-                    logger.info(f"Found similar file: {f}")
-                    # Update metadata
-                    download_metadata[video_id]['filename'] = f
-                    
-                    def cleanup_similar():
-                        try:
-                            time.sleep(5)
-                            if video_id in download_progress:
-                                del download_progress[video_id]
-                            if video_id in download_metadata:
-                                del download_metadata[video_id]
-                        except Exception as e:
-                            logger.error(f"Error in similar cleanup: {e}")
-                    
-                    response = send_file(file_path, as_attachment=True, download_name=f)
-                    cleanup_thread = threading.Thread(target=cleanup_similar)
-                    cleanup_thread.daemon = True
-                    cleanup_thread.start()
-                    return response
-    except Exception as e:
-        logger.error(f"Error searching for similar files: {e}")
-    
-    logger.error(f"File not found: {filepath}")
-    # List directory contents for debugging
-    try:
-        files = os.listdir(app.config['DOWNLOAD_FOLDER'])
-        logger.error(f"Available files: {files}")
-    except:
-        pass
-        
-    return jsonify({'error': 'File not found'}), 404
-
-if __name__ == '__main__':
+from flask import Flask, render_template, request, send_file, jsonify, Response, stream_with_context
+from flask.json.provider import JSONProvider
+import orjson
+import yt_dlp
+import os
+import sys
+import subprocess
+import threading
+import time
+import re
+import json
+import queue
+import weakref
+import atexit
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from cachetools import TTLCache
+from diskcache import Cache
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson's C encoder, used by jsonify"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app = Flask(__name__)
+app.json = OrjsonProvider(app)
+app.config['DOWNLOAD_FOLDER'] = 'downloads'
+app.config['MAX_DOWNLOAD_AGE'] = timedelta(hours=1)  # Clean up files older than 1 hour
+
+# Let the reverse proxy stream files instead of copying them through Python.
+# nginx: set USE_X_ACCEL_REDIRECT=1 and configure
+#   location /protected/ { internal; alias /abs/path/to/downloads/; }
+# Apache with mod_xsendfile: set USE_X_SENDFILE=1 instead.
+app.config['USE_X_ACCEL_REDIRECT'] = os.environ.get('USE_X_ACCEL_REDIRECT', '').lower() in ('1', 'true', 'yes')
+app.config['X_ACCEL_LOCATION'] = os.environ.get('X_ACCEL_LOCATION', '/protected')
+app.use_x_sendfile = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+
+# Ensure download directory exists
+if not os.path.exists(app.config['DOWNLOAD_FOLDER']):
+    os.makedirs(app.config['DOWNLOAD_FOLDER'])
+
+# Format selector per quality choice, built once instead of per download
+_QUALITY_MAP = {
+    '144p': 'bestvideo[height<=144]+bestaudio/best[height<=144]',
+    '240p': 'bestvideo[height<=240]+bestaudio/best[height<=240]',
+    '360p': 'bestvideo[height<=360]+bestaudio/best[height<=360]',
+    '480p': 'bestvideo[height<=480]+bestaudio/best[height<=480]',
+    '720p': 'bestvideo[height<=720]+bestaudio/best[height<=720]',
+    '1080p': 'bestvideo[height<=1080]+bestaudio/best[height<=1080]',
+    'highest': 'bestvideo+bestaudio/best'
+}
+
+# yt-dlp option templates; callers copy before adding per-call settings
+_SEARCH_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'skip_download': True,
+    'extract_flat': 'in_playlist',  # IDs + basic fields only; no per-entry round-trips
+}
+
+_INFO_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'skip_download': True,
+}
+
+_DOWNLOAD_OPTS = {
+    'outtmpl': os.path.join(app.config['DOWNLOAD_FOLDER'], '%(title)s_%(id)s.%(ext)s'),
+    'quiet': False,
+    'no_warnings': False,
+    'restrictfilenames': True,  # This helps with filename issues
+}
+
+# Store download progress and metadata. TTLCache bounds both stores so
+# entries left behind by completed or failed downloads expire on their own
+# instead of leaking for the life of the server.
+download_progress = TTLCache(maxsize=10000, ttl=3600)
+download_metadata = TTLCache(maxsize=10000, ttl=3600)
+
+# TTLCache is not thread-safe: every operation, even on different keys,
+# touches the shared expiry list. All access to the two stores above goes
+# through this lock, held only for the cache operation itself; per-video
+# locks still serialize read-modify-write of an individual entry. Always
+# acquire the video lock first and the store lock last.
+_store_lock = threading.Lock()
+
+# One lock per video guarding its progress/metadata entries, so concurrent
+# downloads of different videos never contend with each other. Weak values
+# keep the table bounded: a lock lives only while some caller still holds
+# it, so entries vanish once a video's download is done with them.
+_video_locks = weakref.WeakValueDictionary()
+_video_locks_lock = threading.Lock()
+
+def get_video_lock(video_id):
+    """Return the lock guarding this video's progress and metadata entries.
+
+    Callers keep the returned lock alive for as long as they use it (the
+    ``with`` statement holds a strong reference), so handing out a fresh
+    lock after the old one was collected is safe: a collected lock had no
+    remaining users.
+    """
+    with _video_locks_lock:
+        lock = _video_locks.get(video_id)
+        if lock is None:
+            # RLock so the progress hook can publish while already holding it
+            lock = threading.RLock()
+            _video_locks[video_id] = lock
+        return lock
+
+# Cache search results for 30 minutes so repeat queries skip the network round-trip
+search_cache = TTLCache(maxsize=512, ttl=1800)
+search_cache_lock = threading.Lock()
+# Keep the last good result per key so we can serve stale data when YouTube
+# errors. Bounded like search_cache but kept much longer, since it only
+# backstops outages; keys are user-supplied, so an unbounded dict would leak
+stale_search_results = TTLCache(maxsize=512, ttl=86400)
+
+# Persistent metadata cache so re-probing the same video skips the yt-dlp extraction
+video_info_cache = Cache(os.path.join('.cache', 'ytmeta'))
+VIDEO_INFO_CACHE_TTL = 86400  # 24 hours
+
+# In-memory index of downloaded files: video_id -> {'path', 'ctime', 'size'}
+# Lets lookups and cleanup avoid per-request directory scans
+file_index = {}
+file_index_lock = threading.Lock()
+FILE_INDEX_PATH = os.path.join('.cache', 'file_index.json')
+
+def index_downloaded_file(video_id, filepath):
+    """Record a finished download in the file index"""
+    try:
+        size = os.path.getsize(filepath) if os.path.isfile(filepath) else 0
+    except OSError:
+        size = 0
+    with file_index_lock:
+        file_index[video_id] = {'path': filepath, 'ctime': time.time(), 'size': size}
+
+def save_file_index():
+    """Persist the file index so restarts don't need a directory rescan"""
+    try:
+        with file_index_lock:
+            snapshot = dict(file_index)
+        with open(FILE_INDEX_PATH, 'w') as f:
+            json.dump(snapshot, f)
+    except Exception as e:
+        logger.error(f"Error saving file index: {e}")
+
+def load_file_index():
+    """Rebuild the file index from the persisted copy, dropping dead entries"""
+    try:
+        with open(FILE_INDEX_PATH) as f:
+            saved = json.load(f)
+        with file_index_lock:
+            for video_id, entry in saved.items():
+                if os.path.isfile(entry.get('path', '')):
+                    file_index[video_id] = entry
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Error loading file index: {e}")
+
+load_file_index()
+atexit.register(save_file_index)
+
+# Bounded worker pools so a burst of /api/download requests can't spawn an
+# unbounded number of yt-dlp/ffmpeg jobs. Audio extractions get their own small
+# pool so CPU-bound transcodes don't starve network-bound video fetches.
+DOWNLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix='download')
+AUDIO_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='audio')
+
+# Pool that fans out per-entry detail resolution during search, so 20 metadata
+# round-trips overlap instead of running back to back
+SEARCH_RESOLVE_EXECUTOR = ThreadPoolExecutor(max_workers=10, thread_name_prefix='resolve')
+
+# Pending/running download futures: video_id -> Future
+download_futures = {}
+
+# Thread-local YoutubeDL instances keyed by option set. Each thread reuses
+# extractor setup and a warm HTTP connection pool across calls, but never
+# shares an instance (yt-dlp is not guaranteed thread-safe), so concurrent
+# extractions on different threads run fully in parallel
+_ydl_local = threading.local()
+
+def _freeze_opts(ydl_opts):
+    """Turn a ydl option dict into a hashable cache key"""
+    def freeze(value):
+        if isinstance(value, dict):
+            return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+        if isinstance(value, (list, tuple)):
+            return tuple(freeze(v) for v in value)
+        return value
+    return freeze(ydl_opts)
+
+def get_ydl(ydl_opts):
+    """Return this thread's YoutubeDL instance for the given option set.
+
+    Meant for short search/info extractions; long-running downloads build
+    per-call instances instead so a thread's instance is never tied up
+    for minutes at a time.
+    """
+    instances = getattr(_ydl_local, 'instances', None)
+    if instances is None:
+        instances = _ydl_local.instances = {}
+    key = _freeze_opts(ydl_opts)
+    ydl = instances.get(key)
+    if ydl is None:
+        # Construct from a copy so yt-dlp never mutates the caller's template
+        ydl = instances[key] = yt_dlp.YoutubeDL(dict(ydl_opts))
+    return ydl
+
+# Per-video queues feeding the SSE progress stream: video_id -> [Queue, ...]
+progress_queues = {}
+progress_queues_lock = threading.Lock()
+PROGRESS_EVENT_MIN_INTERVAL = 0.1  # Coalesce pushes to at most 10 events/s
+_last_progress_push = {}
+
+def publish_progress(video_id, force=False):
+    """Push the current progress snapshot to any SSE listeners for this video"""
+    now = time.monotonic()
+    if not force and now - _last_progress_push.get(video_id, 0.0) < PROGRESS_EVENT_MIN_INTERVAL:
+        return
+
+    with get_video_lock(video_id):
+        with _store_lock:
+            snapshot = download_progress.get(video_id)
+        if snapshot is None:
+            _last_progress_push.pop(video_id, None)
+            return
+        snapshot = dict(snapshot)
+
+    if snapshot.get('status') in ('completed', 'error'):
+        # Final push for this video: drop its throttle timestamp so the
+        # dict doesn't retain one entry per video_id forever
+        _last_progress_push.pop(video_id, None)
+    else:
+        _last_progress_push[video_id] = now
+
+    with progress_queues_lock:
+        listeners = list(progress_queues.get(video_id, ()))
+    for listener in listeners:
+        try:
+            listener.put_nowait(snapshot)
+        except queue.Full:
+            pass  # Slow client; it will catch up on the next event
+
+# Translation table that strips invalid file characters in one C-level pass
+_INVALID_FILENAME_CHARS = str.maketrans('', '', '<>:"/\\|?*')
+
+def sanitize_filename(filename):
+    """Remove invalid characters from filename"""
+    # Strip invalid characters, replace spaces, and cap length to avoid OS path limits
+    return filename.translate(_INVALID_FILENAME_CHARS).replace(' ', '_')[:150]
+
+def cleanup_old_files():
+    """Remove files older than MAX_DOWNLOAD_AGE"""
+    try:
+        now = time.time()
+        max_age = app.config['MAX_DOWNLOAD_AGE'].total_seconds()
+
+        # Always sweep the directory itself: the index only covers files we
+        # tracked, not ones orphaned by a crash or the fallback lookups, and
+        # this runs on the background thread, off the request path.
+        # scandir reuses the stat from the directory read (one syscall per entry)
+        removed = set()
+        with os.scandir(app.config['DOWNLOAD_FOLDER']) as entries_it:
+            for entry in entries_it:
+                if entry.is_file() and now - entry.stat().st_ctime > max_age:
+                    try:
+                        os.remove(entry.path)
+                        logger.info(f"Removed old file: {entry.name}")
+                        removed.add(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+        # Drop index entries whose files just went away (or vanished earlier);
+        # the index stays a serve-path lookup, not the source of truth
+        with file_index_lock:
+            stale_ids = [
+                video_id for video_id, entry in file_index.items()
+                if entry['path'] in removed or not os.path.exists(entry['path'])
+            ]
+            for video_id in stale_ids:
+                file_index.pop(video_id, None)
+    except Exception as e:
+        logger.error(f"Error in cleanup_old_files: {e}")
+
+CLEANUP_INTERVAL = 300  # Run cleanup every 5 minutes, off the request path
+
+def _cleanup_worker():
+    while True:
+        time.sleep(CLEANUP_INTERVAL)
+        cleanup_old_files()
+
+threading.Thread(target=_cleanup_worker, daemon=True, name='cleanup').start()
+
+def send_download(filepath, download_name):
+    """Send a file as an attachment, offloading to the reverse proxy when configured"""
+    if app.config['USE_X_ACCEL_REDIRECT']:
+        # nginx streams the file via sendfile(2); Python only emits headers
+        response = app.response_class(status=200)
+        response.headers['X-Accel-Redirect'] = f"{app.config['X_ACCEL_LOCATION']}/{os.path.basename(filepath)}"
+        response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+        response.headers['Content-Type'] = 'application/octet-stream'
+        return response
+    # Dev fallback: Flask serves the file itself (honors app.use_x_sendfile)
+    return send_file(filepath, as_attachment=True, download_name=download_name)
+
+def format_duration(duration):
+    """Format duration from seconds to HH:MM:SS or MM:SS"""
+    if not duration:
+        return "Unknown"
+    
+    hours = int(duration // 3600)
+    minutes = int((duration % 3600) // 60)
+    seconds = int(duration % 60)
+    
+    if hours > 0:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    else:
+        return f"{minutes}:{seconds:02d}"
+
+def format_views(views):
+    """Format view count in a readable format"""
+    if not views:
+        return "Unknown"
+    
+    if views >= 1000000:
+        return f"{views / 1000000:.1f}M"
+    elif views >= 1000:
+        return f"{views / 1000:.1f}K"
+    else:
+        return str(views)
+
+def is_stale(cached, fresh_flat):
+    """Cheap ETag-style staleness check of cached metadata against a flat entry.
+
+    View counts are bucketed to the thousand so ordinary drift doesn't
+    invalidate the cache; a changed upload date (edited/replaced video)
+    always does. Flat entries missing either field are treated as fresh.
+    """
+    fresh_views = fresh_flat.get('view_count')
+    if fresh_views is not None and fresh_views // 1000 != (cached.get('views') or 0) // 1000:
+        return True
+    fresh_date = fresh_flat.get('upload_date')
+    if fresh_date and fresh_date != cached.get('upload_date'):
+        return True
+    return False
+
+def _evict_if_stale(entry):
+    """Drop the disk-cached metadata for a flat entry that is out of date"""
+    video_id = entry.get('id')
+    if video_id:
+        cached = video_info_cache.get(video_id)
+        if cached is not None and is_stale(cached, entry):
+            video_info_cache.delete(video_id)
+            logger.info(f"Evicted stale cached metadata for video: {video_id}")
+
+def _shape_search_entry(entry):
+    """Build the client-facing dict for one (possibly flat) search entry"""
+    # Flat entries carry a thumbnails list instead of a single thumbnail
+    thumbnail = entry.get('thumbnail', '')
+    if not thumbnail and entry.get('thumbnails'):
+        thumbnail = entry['thumbnails'][-1].get('url', '')
+    desc = entry.get('description') or ''
+    return {
+        'id': entry.get('id', ''),
+        'title': entry.get('title', 'Unknown Title'),
+        'thumbnail': thumbnail,
+        'duration': entry.get('duration', 0),
+        'duration_formatted': format_duration(entry.get('duration', 0)),
+        'views': entry.get('view_count', 0),
+        'views_formatted': format_views(entry.get('view_count', 0)),
+        'author': entry.get('uploader', 'Unknown Author'),
+        'url': f"https://www.youtube.com/watch?v={entry.get('id', '')}",
+        'description': (desc[:200] + '...') if len(desc) > 200 else desc,
+        'upload_date': entry.get('upload_date', '')
+    }
+
+def _shape_video_info(info):
+    """Build the client-facing metadata dict from a full extraction result"""
+    desc = info.get('description') or ''
+    return {
+        'title': info.get('title', 'Unknown Title'),
+        'thumbnail': info.get('thumbnail', ''),
+        'duration': info.get('duration', 0),
+        'duration_formatted': format_duration(info.get('duration', 0)),
+        'views': info.get('view_count', 0),
+        'views_formatted': format_views(info.get('view_count', 0)),
+        'author': info.get('uploader', 'Unknown Author'),
+        'video_id': info.get('id', ''),
+        'description': (desc[:300] + '...') if len(desc) > 300 else desc,
+        'upload_date': info.get('upload_date', '')
+    }
+
+def _resolve_search_entry(entry):
+    """Resolve full metadata for one flat search entry, via the disk cache when warm"""
+    shaped = _shape_search_entry(entry)
+    video_id = shaped['id']
+    if not video_id:
+        return shaped
+
+    cached = video_info_cache.get(video_id)
+    if cached is None:
+        try:
+            info = get_ydl(_INFO_OPTS).extract_info(f"https://www.youtube.com/watch?v={video_id}", download=False)
+        except Exception as e:
+            logger.error(f"Error resolving search entry {video_id}: {e}")
+            return shaped  # Fall back to the flat fields
+        cached = _shape_video_info(info)
+        video_info_cache.set(video_id, cached, expire=VIDEO_INFO_CACHE_TTL)
+
+    # Overlay the detailed fields onto the search-result shape
+    shaped.update(
+        title=cached.get('title', shaped['title']),
+        thumbnail=cached.get('thumbnail') or shaped['thumbnail'],
+        duration=cached.get('duration', shaped['duration']),
+        duration_formatted=cached.get('duration_formatted', shaped['duration_formatted']),
+        views=cached.get('views', shaped['views']),
+        views_formatted=cached.get('views_formatted', shaped['views_formatted']),
+        author=cached.get('author', shaped['author']),
+        description=cached.get('description') or shaped['description'],
+        upload_date=cached.get('upload_date') or shaped['upload_date'],
+    )
+    return shaped
+
+def search_youtube_videos(query, max_results=20):
+    """Search for YouTube videos using yt-dlp"""
+    cache_key = (query.lower().strip(), max_results)
+
+    with search_cache_lock:
+        cached = search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    try:
+        search_query = f"ytsearch{max_results}:{query}"
+
+        search_results = get_ydl(_SEARCH_OPTS).extract_info(search_query, download=False)
+
+        videos = []
+        if 'entries' in search_results:
+            entries = [entry for entry in search_results['entries'] if entry]  # Entries can be None
+            for entry in entries:
+                _evict_if_stale(entry)
+            # Fan the detail resolutions out across the pool; cache hits return
+            # instantly, misses overlap their network round-trips
+            videos = list(SEARCH_RESOLVE_EXECUTOR.map(_resolve_search_entry, entries))
+
+        with search_cache_lock:
+            search_cache[cache_key] = videos
+            stale_search_results[cache_key] = videos
+
+        return videos
+    except Exception as e:
+        logger.error(f"Error in search_youtube_videos: {e}")
+        # Serve the last known good result (if any) when YouTube rate-limits or errors
+        with search_cache_lock:
+            stale = stale_search_results.get(cache_key)
+        if stale is not None:
+            logger.info(f"Serving stale search results for query: {query}")
+            return stale
+        return []
+
+def get_video_info(url):
+    # Key the cache by video ID so youtu.be and youtube.com URLs share entries
+    video_id = get_video_id(url)
+    if video_id:
+        cached = video_info_cache.get(video_id)
+        if cached is not None:
+            return cached
+
+    try:
+        info = get_ydl(_INFO_OPTS).extract_info(url, download=False)
+
+        video_info = _shape_video_info(info)
+        if video_info['video_id']:
+            video_info_cache.set(video_info['video_id'], video_info, expire=VIDEO_INFO_CACHE_TTL)
+        return video_info
+    except Exception as e:
+        logger.error(f"Error in get_video_info: {e}")
+        return {'error': str(e)}
+
+def get_many_video_info(video_ids):
+    """Resolve detailed metadata for several videos in one yt-dlp context"""
+    results = {}
+    pending = []
+
+    for video_id in video_ids:
+        cached = video_info_cache.get(video_id)
+        if cached is not None:
+            results[video_id] = cached
+        else:
+            pending.append(video_id)
+
+    if pending:
+        # One YoutubeDL for the whole batch so the HTTP session is reused
+        ydl = get_ydl(_INFO_OPTS)
+        for video_id in pending:
+            try:
+                info = ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=False)
+            except Exception as e:
+                logger.error(f"Error resolving video {video_id}: {e}")
+                results[video_id] = {'error': str(e)}
+                continue
+
+            video_info = _shape_video_info(info)
+            video_info_cache.set(video_id, video_info, expire=VIDEO_INFO_CACHE_TTL)
+            results[video_id] = video_info
+
+    return results
+
+# Matches youtu.be/<id> and watch?v=<id>; video IDs are 11 URL-safe characters,
+# so a successful match doubles as input validation
+_VIDEO_ID_RE = re.compile(r'(?:youtu\.be/|[?&]v=)([A-Za-z0-9_-]{11})')
+
+def get_video_id(url):
+    """Extract video ID from YouTube URL"""
+    if not url:
+        return None
+    match = _VIDEO_ID_RE.search(url)
+    return match.group(1) if match else None
+
+def progress_hook(d, video_id):
+    """Progress hook for yt-dlp downloads"""
+    with get_video_lock(video_id):
+        with _store_lock:
+            entry = download_progress.get(video_id)
+        if entry is None:
+            return
+
+        status = d['status']
+        if status == 'downloading':
+            total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate') or 1
+            downloaded_bytes = d.get('downloaded_bytes', 0)
+
+            # This hook fires hundreds of times per second; only rewrite state
+            # once another MiB has actually arrived
+            if downloaded_bytes - entry.get('downloaded_bytes', 0) < (1 << 20):
+                return
+
+            entry.update(
+                progress=(downloaded_bytes / total_bytes) * 100,
+                status='downloading',
+                downloaded_bytes=downloaded_bytes,
+                total_bytes=total_bytes,
+            )
+            publish_progress(video_id)
+
+        elif status == 'finished':
+            # Set to processing; will be updated to completed later
+            entry.update(progress=100, status='processing', filepath=d['filename'])
+            index_downloaded_file(video_id, d['filename'])
+            publish_progress(video_id, force=True)
+            logger.info(f"Download finished. File path: {d['filename']}")
+
+# Progress lines printed by the yt-dlp CLI, e.g. "[download]  42.3% of ..."
+_SUBPROCESS_PROGRESS_RE = re.compile(r'\[download\]\s+(\d+(?:\.\d+)?)%')
+
+def download_audio_subprocess(url, video_id):
+    """Download and extract audio with the yt-dlp CLI.
+
+    The ffmpeg transcode then runs entirely outside this process, so the
+    worker thread only tails stdout instead of holding the GIL through
+    yt-dlp's Python-side muxing and probing.
+    """
+    cmd = [
+        sys.executable, '-m', 'yt_dlp',
+        '-x', '--audio-format', 'mp3', '--audio-quality', '192',
+        '--restrict-filenames', '--newline',
+        '-o', _DOWNLOAD_OPTS['outtmpl'],
+        url,
+    ]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    for line in proc.stdout:
+        match = _SUBPROCESS_PROGRESS_RE.search(line)
+        if match:
+            with get_video_lock(video_id):
+                with _store_lock:
+                    entry = download_progress.get(video_id)
+                if entry is not None:
+                    entry.update(progress=float(match.group(1)), status='downloading')
+                    publish_progress(video_id)
+    returncode = proc.wait()
+    if returncode != 0:
+        raise RuntimeError(f"yt-dlp exited with status {returncode}")
+
+def download_video(url, quality, audio_only=False):
+    """Download video with improved error handling and file tracking"""
+    video_id = get_video_id(url)
+    if not video_id:
+        logger.error("Could not extract video ID from URL")
+        return None, "Could not extract video ID from URL"
+    
+    try:
+        # Initialize download progress
+        with get_video_lock(video_id):
+            with _store_lock:
+                download_progress[video_id] = {
+                    'progress': 0,
+                    'filename': None,
+                    'filepath': None,
+                    'status': 'starting',
+                    'start_time': time.time()
+                }
+
+        if audio_only:
+            # Shell out so the ffmpeg transcode runs outside this process;
+            # the final .mp3 is located below by video ID
+            download_audio_subprocess(url, video_id)
+            info = get_video_info(url)  # served from the metadata cache when warm
+            expected_filename = ''
+        else:
+            # Completion signal from yt-dlp's postprocessors (merge, move-files),
+            # so we never have to sleep a fixed interval waiting for the file
+            pp_done = threading.Event()
+
+            def pp_hook(d):
+                if d['status'] == 'finished':
+                    pp_done.set()
+
+            # Copy the template, then add per-call settings. Downloads use a
+            # per-call instance rather than get_ydl: they run for minutes, and
+            # serializing same-quality downloads on a shared instance lock
+            # would defeat the worker pool
+            ydl_opts = _DOWNLOAD_OPTS.copy()
+            ydl_opts['format'] = _QUALITY_MAP.get(quality, _QUALITY_MAP['highest'])
+            ydl_opts['progress_hooks'] = [lambda d: progress_hook(d, video_id)]
+            ydl_opts['postprocessor_hooks'] = [pp_hook]
+
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.extract_info(url, download=True)
+                expected_filename = ydl.prepare_filename(info)
+
+        # Store metadata immediately after getting info
+        with get_video_lock(video_id):
+            with _store_lock:
+                download_metadata[video_id] = {
+                    'title': info.get('title', 'Unknown'),
+                    'download_time': datetime.now().isoformat(),
+                    'url': url,
+                    'quality': quality,
+                    'audio_only': audio_only
+                }
+
+        if not audio_only:
+            # extract_info runs postprocessors synchronously, so the event is
+            # normally already set and this returns immediately; the timeout
+            # only bounds the wait if no postprocessor ever fires
+            pp_done.wait(timeout=5)
+
+        # Try to find the downloaded file
+        actual_file = None
+
+        logger.info(f"Expected filename: {expected_filename}")
+
+        # Check if the exact file exists
+        if expected_filename and os.path.exists(expected_filename) and os.path.getsize(expected_filename) > 0:
+            actual_file = expected_filename
+        else:
+            # Search for similar files in the download directory
+            try:
+                files_with_time = []
+                with os.scandir(app.config['DOWNLOAD_FOLDER']) as entries_it:
+                    for entry in entries_it:
+                        if not entry.is_file():
+                            continue
+                        stat = entry.stat()
+                        if stat.st_size == 0:
+                            continue
+                        # Check if the video ID is in the filename
+                        if video_id in entry.name:
+                            actual_file = entry.path
+                            logger.info(f"Found file by video ID: {entry.name}")
+                            break
+                        files_with_time.append((entry.path, entry.name, stat.st_mtime))
+
+                # If still not found, get the most recent file
+                if not actual_file and files_with_time:
+                    # Sort by modification time (most recent first)
+                    files_with_time.sort(key=lambda x: x[2], reverse=True)
+                    actual_file = files_with_time[0][0]
+                    logger.info(f"Using most recent file: {files_with_time[0][1]}")
+
+            except Exception as e:
+                logger.error(f"Error searching for downloaded file: {e}")
+
+        if actual_file:
+            final_filename = os.path.basename(actual_file)
+
+            # Update progress and metadata with final file info
+            with get_video_lock(video_id):
+                with _store_lock:
+                    download_progress[video_id].update(
+                        filename=final_filename,
+                        filepath=actual_file,
+                        status='completed',
+                        end_time=time.time(),
+                    )
+                    download_metadata[video_id]['filename'] = final_filename
+                # Re-index with the final path (postprocessors may have renamed the file)
+                index_downloaded_file(video_id, actual_file)
+                publish_progress(video_id, force=True)
+
+            logger.info(f"Download completed successfully: {actual_file}")
+            return actual_file, None
+        else:
+            error_msg = "Download completed but file not found"
+            with get_video_lock(video_id):
+                with _store_lock:
+                    download_progress[video_id].update(status='error', error=error_msg)
+                publish_progress(video_id, force=True)
+            logger.error(f"File not found after download. Expected: {expected_filename}")
+            return None, error_msg
+
+    except Exception as e:
+        error_msg = str(e)
+        logger.error(f"Error in download_video: {error_msg}")
+        with get_video_lock(video_id):
+            with _store_lock:
+                entry = download_progress.get(video_id)
+            if entry is not None:
+                entry.update(status='error', error=error_msg)
+                publish_progress(video_id, force=True)
+        return None, error_msg
+
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+@app.route('/api/search', methods=['GET'])
+def search_videos():
+    query = request.args.get('q', '').strip()
+    max_results = int(request.args.get('max_results', 20))
+    
+    if not query:
+        return jsonify({'error': 'No search query provided'})
+    
+    try:
+        videos = search_youtube_videos(query, max_results)
+        return jsonify({'videos': videos, 'total': len(videos)})
+    except Exception as e:
+        logger.error(f"Search error: {e}")
+        return jsonify({'error': str(e)})
+
+@app.route('/api/search/stream', methods=['GET'])
+def search_videos_stream():
+    """Stream search results as NDJSON, one video per line, as they resolve"""
+    query = request.args.get('q', '').strip()
+    max_results = int(request.args.get('max_results', 20))
+
+    if not query:
+        return jsonify({'error': 'No search query provided'})
+
+    def generate():
+        try:
+            search_results = get_ydl(_SEARCH_OPTS).extract_info(f"ytsearch{max_results}:{query}", download=False)
+            # Materialize up front; entries may be a lazy iterable and we don't
+            # want extraction work interleaved with a slow client's reads
+            entries = list(search_results.get('entries') or [])
+            entries = [entry for entry in entries if entry]
+            for entry in entries:
+                _evict_if_stale(entry)
+            # Yield each video as its detail resolution finishes, fastest first
+            futures = [SEARCH_RESOLVE_EXECUTOR.submit(_resolve_search_entry, entry) for entry in entries]
+            for future in as_completed(futures):
+                yield orjson.dumps(future.result()) + b'\n'
+        except Exception as e:
+            logger.error(f"Error streaming search results: {e}")
+            yield orjson.dumps({'error': str(e)}) + b'\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/search/invalidate', methods=['POST'])
+def invalidate_search_cache():
+    """Drop cached search results so the next query hits YouTube again"""
+    with search_cache_lock:
+        cleared = len(search_cache)
+        search_cache.clear()
+        stale_search_results.clear()
+    return jsonify({'cleared': cleared})
+
+@app.route('/api/cache/purge/<video_id>', methods=['POST'])
+def purge_video_info_cache(video_id):
+    """Drop the cached metadata for one video so the next probe re-extracts it"""
+    purged = video_info_cache.delete(video_id)
+    return jsonify({'video_id': video_id, 'purged': bool(purged)})
+
+@app.route('/api/video_info', methods=['GET'])
+def video_info():
+    url = request.args.get('url')
+    if not url:
+        return jsonify({'error': 'No URL provided'})
+    
+    info = get_video_info(url)
+    return jsonify(info)
+
+@app.route('/api/video_info_batch', methods=['POST'])
+def video_info_batch():
+    data = request.json or {}
+    video_ids = data.get('ids')
+
+    if not video_ids or not isinstance(video_ids, list):
+        return jsonify({'error': 'No video IDs provided'})
+    if len(video_ids) > 50:
+        return jsonify({'error': 'Maximum 50 video IDs per request'}), 400
+
+    results = get_many_video_info(video_ids)
+    return jsonify({'videos': results, 'total': len(results)})
+
+@app.route('/api/download', methods=['POST'])
+def download():
+    data = request.json
+    url = data.get('url')
+    quality = data.get('quality')
+    audio_only = data.get('audio_only', False)
+    
+    if not url:
+        return jsonify({'error': 'No URL provided'})
+    
+    # Get video ID for progress tracking
+    video_id = get_video_id(url)
+    if not video_id:
+        return jsonify({'error': 'Could not extract video ID from URL'})
+    
+    # The duplicate check, state reset and submit all happen under the
+    # video's lock, so two concurrent POSTs for the same video can't both
+    # pass the check and wipe the state of the job that wins
+    with get_video_lock(video_id):
+        existing = download_futures.get(video_id)
+        if existing is not None and not existing.done():
+            return jsonify({'video_id': video_id, 'status': 'already_downloading'})
+
+        # Clean up any previous state for this video
+        with _store_lock:
+            download_progress.pop(video_id, None)
+            download_metadata.pop(video_id, None)
+
+        # Queue the download on the bounded pool; audio jobs use the transcode pool
+        executor = AUDIO_EXECUTOR if audio_only else DOWNLOAD_EXECUTOR
+        future = executor.submit(download_video, url, quality, audio_only)
+        download_futures[video_id] = future
+
+        # Drop the handle once the job finishes so the dict can't grow
+        # forever; the pop takes the video lock too, so every access to this
+        # video's future is serialized
+        def _discard_future(_f):
+            with get_video_lock(video_id):
+                download_futures.pop(video_id, None)
+
+        future.add_done_callback(_discard_future)
+
+    return jsonify({'video_id': video_id})
+
+@app.route('/api/progress/<video_id>', methods=['GET'])
+def progress(video_id):
+    with get_video_lock(video_id):
+        with _store_lock:
+            entry = download_progress.get(video_id)
+        if entry is None:
+            return jsonify({'progress': 0, 'status': 'not found'})
+        progress_data = entry.copy()
+
+    # If download is completed, verify file still exists
+    if progress_data.get('status') == 'completed':
+        filename = progress_data.get('filename')
+        if filename:
+            file_path = os.path.join(app.config['DOWNLOAD_FOLDER'], filename)
+            if not os.path.exists(file_path):
+                progress_data['status'] = 'error'
+                progress_data['error'] = 'Downloaded file not found'
+
+    return jsonify(progress_data)
+
+@app.route('/api/progress_stream/<video_id>', methods=['GET'])
+def progress_stream(video_id):
+    """Push progress updates over Server-Sent Events instead of polling"""
+    listener = queue.Queue(maxsize=100)
+    with progress_queues_lock:
+        progress_queues.setdefault(video_id, []).append(listener)
+
+    def generate():
+        try:
+            # Send the current state right away so clients don't wait for the next event
+            with get_video_lock(video_id):
+                with _store_lock:
+                    current = download_progress.get(video_id)
+                if current is not None:
+                    current = dict(current)
+            if current is not None:
+                yield f"data: {json.dumps(current)}\n\n"
+                if current.get('status') in ('completed', 'error'):
+                    return
+
+            while True:
+                try:
+                    snapshot = listener.get(timeout=30)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"data: {json.dumps(snapshot)}\n\n"
+                if snapshot.get('status') in ('completed', 'error'):
+                    return
+        finally:
+            with progress_queues_lock:
+                listeners = progress_queues.get(video_id)
+                if listeners and listener in listeners:
+                    listeners.remove(listener)
+                    if not listeners:
+                        progress_queues.pop(video_id, None)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+
+@app.route('/api/download_file/<video_id>', methods=['GET'])
+def download_file(video_id):
+    """Handle file download requests"""
+    logger.info(f"Download file requested for video_id: {video_id}")
+    with _store_lock:
+        metadata_keys = list(download_metadata.keys())
+    logger.info(f"Available metadata keys: {metadata_keys}")
+
+    # O(1) lookup from the file index before falling back to directory scans
+    with file_index_lock:
+        indexed = file_index.get(video_id)
+
+    # Check if we have metadata for this video
+    with _store_lock:
+        meta = download_metadata.get(video_id)
+    if meta is None:
+        logger.warning(f"No metadata found for video_id: {video_id}")
+
+        if indexed and os.path.isfile(indexed['path']):
+            meta = {
+                'filename': os.path.basename(indexed['path']),
+                'title': 'Downloaded Video',
+                'download_time': datetime.now().isoformat()
+            }
+            with get_video_lock(video_id):
+                with _store_lock:
+                    download_metadata[video_id] = meta
+            logger.info(f"Recovered metadata from file index: {indexed['path']}")
+        else:
+            # Try to find any recent download files as fallback
+            try:
+                recent_files = []
+                current_time = time.time()
+                with os.scandir(app.config['DOWNLOAD_FOLDER']) as entries_it:
+                    for entry in entries_it:
+                        if entry.is_file():
+                            stat = entry.stat()
+                            file_age = current_time - stat.st_ctime
+                            if file_age < 300 and stat.st_size > 0:  # Files from last 5 minutes
+                                recent_files.append((entry.path, entry.name, file_age))
+
+                if recent_files:
+                    # Sort by creation time, get the most recent
+                    recent_files.sort(key=lambda x: x[2])  # Sort by age (ascending)
+                    most_recent = recent_files[0]
+                    logger.info(f"Using most recent file as fallback: {most_recent[1]}")
+
+                    # Create temporary metadata
+                    meta = {
+                        'filename': most_recent[1],
+                        'title': 'Downloaded Video',
+                        'download_time': datetime.now().isoformat()
+                    }
+                    with get_video_lock(video_id):
+                        with _store_lock:
+                            download_metadata[video_id] = meta
+
+            except Exception as e:
+                logger.error(f"Error finding fallback file: {e}")
+                return jsonify({'error': 'Download not found or expired'}), 404
+
+        if meta is None:
+            return jsonify({'error': 'Download not found or expired'}), 404
+
+    if indexed and os.path.isfile(indexed['path']):
+        filepath = indexed['path']
+        filename = os.path.basename(filepath)
+    else:
+        filename = meta['filename']
+        filepath = os.path.join(app.config['DOWNLOAD_FOLDER'], filename)
+
+    logger.info(f"Looking for file: {filepath}")
+    
+    # Security check to prevent directory traversal
+    if '..' in filename or filename.startswith('/'):
+        logger.warning(f"Invalid filename detected: {filename}")
+        return jsonify({'error': 'Invalid filename'}), 400
+    
+    # Check if file exists and is not empty
+    if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
+        # Get the title for download name
+        title = meta.get('title', 'video')
+        safe_title = sanitize_filename(title)
+        file_extension = os.path.splitext(filename)[1]
+        download_name = f"{safe_title}{file_extension}"
+        
+        logger.info(f"Sending file: {filepath} as {download_name}")
+
+        # No explicit cleanup needed: progress/metadata entries expire via TTL
+        try:
+            return send_download(filepath, download_name)
+        except Exception as send_error:
+            logger.error(f"Error sending file: {send_error}")
+            return jsonify({'error': 'Error sending file'}), 500
+    
+    # If file not found, try to find a similar file
+    logger.warning(f"File not found at expected path: {filepath}")
+    try:
+        with os.scandir(app.config['DOWNLOAD_FOLDER']) as entries_it:
+            for entry in entries_it:
+                if entry.is_file() and entry.stat().st_size > 0:
+                    # Match by video ID or filename similarity
+                    if video_id in entry.name or entry.name.startswith(os.path.splitext(filename)[0][:20]):
+                        logger.info(f"Found similar file: {entry.name}")
+                        # Update metadata; the entry expires via TTL, no cleanup thread
+                        with get_video_lock(video_id):
+                            meta['filename'] = entry.name
+                        return send_download(entry.path, entry.name)
+    except Exception as e:
+        logger.error(f"Error searching for similar files: {e}")
+    
+    logger.error(f"File not found: {filepath}")
+    # List directory contents for debugging
+    try:
+        files = os.listdir(app.config['DOWNLOAD_FOLDER'])
+        logger.error(f"Available files: {files}")
+    except:
+        pass
+        
+    return jsonify({'error': 'File not found'}), 404
+
+if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file